@@ -54,14 +54,220 @@ from __future__ import print_function
 import os
 import sys
 import re
+import json
+import time
 import tempfile
 import shutil
 import subprocess
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 # Set to true to do symbol translation as well as downloading. Set to
 # false to just download symbols and let WPA translate them.
 strip_and_translate = True
 
+# Maximum number of RetrieveSymbols.exe instances to run at once. Retrieval is
+# dominated by symbol server latency so running several in parallel helps.
+max_parallel_retrieves = 8
+
+# Failed RetrieveSymbols.exe attempts for locally built PDBs, which will never
+# be on the symbol server, are recorded in this file so that they don't cost a
+# slow retrieval attempt on every run. Retrieval of a PDB is skipped for this
+# many seconds after a failed attempt. Only attempts where RetrieveSymbols.exe
+# reported ERROR_FILE_NOT_FOUND are recorded, since other errors (timeouts,
+# missing DLLs, random symbol server failures) are likely to be transient, and
+# PDBs with no local copy are never recorded, since official builds such as a
+# new Canary may just not have had their symbols uploaded yet.
+# Set the environment variable named by failed_retrieves_override to retry all
+# PDBs regardless, e.g. after a new Canary's symbols have been uploaded.
+failed_retrieves_path = os.path.join(tempfile.gettempdir(), "StripChromeSymbols_failed.json")
+failed_retrieve_skip_time = 24 * 60 * 60
+failed_retrieves_override = "STRIPCHROMESYMBOLS_RETRY_FAILED"
+
+# Typical output looks like:
+# "[RSDS] PdbSig: {0e7712be-af06-4421-884b-496f833c8ec1}; Age: 33; Pdb: D:\src\chromium2\src\out\Release\initial\chrome.dll.pdb"
+# Note that this output implies a .symcache filename like this:
+# chrome.dll-0e7712beaf064421884b496f833c8ec121v2.symcache
+# In particular, note that the xperf action prints the age in decimal, but the
+# symcache names use the age in hexadecimal!
+# The character classes are deliberately narrow so that non-matching lines are
+# rejected without backtracking.
+pdb_re = re.compile(r'"\[RSDS\] PdbSig: {([0-9a-fA-F-]+)}; Age: (\d+); Pdb: ([^"]+)"')
+pdb_cached_re = re.compile(r"Found .*file - placed it in (.*)")
+# RetrieveSymbols.exe prints this for any SymFindFileInPath failure, with the
+# GetLastError() value.
+pdb_not_found_re = re.compile(r"Error: symbols not found - error (\d+)")
+# The Win32 error code for a PDB that isn't on the symbol server.
+ERROR_FILE_NOT_FOUND = 2
+
+# Complete list of Chrome executables and binaries. Some are only used in internal builds.
+# Note that case matters for downloading PDBs.
+chrome_pdb_names = ["chrome.exe.pdb", "chrome_proxy.exe.pdb", "chrome.dll.pdb", "blink_web.dll.pdb", "content.dll.pdb", "chrome_elf.dll.pdb", "chrome_watcher.dll.pdb", "libEGL.dll.pdb", "libGLESv2.dll.pdb", "eventlog_provider.dll.pdb"]
+# The strings to look for in the raw xperf output to find the chrome PDBs.
+chrome_pdb_markers = [(pe_name, ("Pdb: " + pe_name).encode()) for pe_name in chrome_pdb_names]
+
+def _IterLines(command, check=True, text=True):
+  """
+  Runs the specified command and yields its output (stdout and stderr) one line
+  at a time as it is produced, rather than buffering all of it. stdin is
+  explicitly redirected because inheriting it fails when UIforETW launches this
+  script without a console. If check is True then CalledProcessError is raised
+  if the command fails, as with subprocess.check_output. If text is False then
+  the lines are returned as undecoded bytes.
+  """
+  devnull = open(os.devnull, "r")
+  try:
+    proc = subprocess.Popen(command, stdin=devnull, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, universal_newlines=text)
+    for line in iter(proc.stdout.readline, "" if text else b""):
+      yield line.rstrip()
+    proc.stdout.close()
+    if proc.wait() and check:
+      raise subprocess.CalledProcessError(proc.returncode, command)
+  finally:
+    devnull.close()
+
+def _CopyIfChanged(source, dest):
+  """
+  Makes dest a copy of source, unless it already has the same size and
+  modification time. A hard link is used when possible since it avoids copying
+  the data, with a regular copy as the fallback (e.g. across volumes).
+  """
+  try:
+    source_stat = os.stat(source)
+  except OSError:
+    # Nothing to copy from - dest may already have been put in place.
+    return
+  if os.path.exists(dest):
+    dest_stat = os.stat(dest)
+    if dest_stat.st_size == source_stat.st_size and \
+        int(dest_stat.st_mtime) == int(source_stat.st_mtime):
+      return
+    try:
+      os.remove(dest)
+    except OSError:
+      # Probably in use, so keep using the existing copy.
+      return
+  try:
+    os.link(source, dest)
+  except (AttributeError, OSError):
+    # os.link is not available on Windows in Python 2.
+    shutil.copy2(source, dest)
+
+def _FailedRetrieveKey(guid, age, filepart):
+  return "%s-%s-%s" % (guid, age, filepart)
+
+def _LoadFailedRetrieves():
+  """
+  Returns a dictionary mapping "guid-age-filepart" keys to the time of the last
+  failed attempt to retrieve that PDB. Attempts that are old enough that the
+  retrieval should be tried again are discarded.
+  """
+  try:
+    with open(failed_retrieves_path) as f:
+      failed_retrieves = json.load(f)
+    now = time.time()
+    return dict((key, when) for key, when in failed_retrieves.items()
+                if now - when < failed_retrieve_skip_time)
+  except (IOError, ValueError, AttributeError, TypeError):
+    # Missing or corrupt - start over.
+    return {}
+
+def _SaveFailedRetrieves(failed_retrieves):
+  """
+  Writes out the dictionary of failed retrieval attempts. The file is written
+  under a temporary name and then renamed so that it is never left half written.
+  """
+  temp_path = failed_retrieves_path + ".tmp"
+  try:
+    with open(temp_path, "w") as f:
+      json.dump(failed_retrieves, f)
+    if os.path.exists(failed_retrieves_path):
+      os.remove(failed_retrieves_path)
+    os.rename(temp_path, failed_retrieves_path)
+  except (IOError, OSError):
+    # This is just an optimization so failing to save it is harmless.
+    pass
+
+def _RetrieveSymbols(retrieve_path, guid, age, filepart):
+  """
+  Runs RetrieveSymbols.exe to download the specified PDB. Returns a tuple of
+  the path to the PDB in the local symbol cache, or None if it could not be
+  retrieved, and whether RetrieveSymbols.exe reported that the symbols are not
+  on the symbol server (ERROR_FILE_NOT_FOUND). The latter is False for any other
+  failure, since those may well be transient.
+  """
+  pdb_cache_path = None
+  not_found = False
+  try:
+    for subline in _IterLines([retrieve_path, guid, str(age), filepart]):
+      # Only the "Found file - placed it in ..." and "Error: symbols not found"
+      # lines are of interest, so avoid running the regexes on the others.
+      # _IterLines already strips the newline.
+      if subline.startswith("Error: "):
+        error_match = pdb_not_found_re.match(subline)
+        if error_match and int(error_match.groups()[0]) == ERROR_FILE_NOT_FOUND:
+          not_found = True
+      if not subline.startswith("Found "):
+        continue
+      cache_match = pdb_cached_re.match(subline)
+      if cache_match:
+        pdb_cache_path = cache_match.groups()[0]
+        # RetrieveSymbols puts a period at the end of the output, so strip that.
+        if pdb_cache_path.endswith("."):
+          pdb_cache_path = pdb_cache_path[:-1]
+  except (subprocess.CalledProcessError, OSError):
+    return None, False
+  return pdb_cache_path, not_found
+
+def _DecodeOutput(output):
+  """
+  Returns the output of a tool as a str. On Python 3 this means decoding it
+  using the ANSI code page.
+  """
+  if not isinstance(output, str):
+    output = output.decode("mbcs", "replace")
+  return output
+
+def _StripPdb(copy_command, un_fastlink_tool, pdb_path):
+  """
+  Runs the specified pdbcopy command to make a stripped copy of pdb_path.
+  Returns the output of pdbcopy to be printed, since this is run on a worker
+  thread, including a description of the error if it failed.
+  """
+  try:
+    with open(os.devnull, "r+") as devnull:
+      try:
+        output = subprocess.check_output(copy_command, stdin=devnull,
+                                         stderr=subprocess.STDOUT)
+      except (subprocess.CalledProcessError, OSError):
+        # If the un_fastlink_tool is available and pdbcopy fails then run the
+        # un_fastlink_tool and try again.
+        if not un_fastlink_tool:
+          raise
+        convert_command = '%s "%s"' % (un_fastlink_tool, pdb_path)
+        # This is printed immediately, rather than returned, so that the
+        # warning shows up before the slow step instead of after it. It is
+        # printed with a single call so that it can't be interleaved with the
+        # messages from other threads.
+        print("Attempting to un-fastlink %s so that pdbcopy can strip it. This may be slow.\n"
+              "  > %s\n" % (pdb_path, convert_command), end="")
+        subprocess.check_call(convert_command, stdin=devnull, stdout=devnull)
+        output = subprocess.check_output(copy_command, stdin=devnull,
+                                         stderr=subprocess.STDOUT)
+  except subprocess.CalledProcessError as e:
+    messages = ""
+    output = _DecodeOutput(e.output or b"").rstrip()
+    if output:
+      messages += "  %s\n" % output
+    return messages + "  %s failed with exit code %d.\n" % (e.cmd, e.returncode)
+  except OSError as e:
+    return "  Stripping %s failed: %s\n" % (pdb_path, e)
+  output = _DecodeOutput(output).rstrip()
+  if output:
+    return "  %s\n" % output
+  return ""
+
 def main():
   if len(sys.argv) < 2:
     print("Usage: %s trace.etl" % sys.argv[0])
@@ -74,17 +280,22 @@ def main():
     sys.exit(0)
 
   symbol_path = os.environ.get("_NT_SYMBOL_PATH", "")
-  if symbol_path.count("chromium-browser-symsrv") == 0:
+  if "chromium-browser-symsrv" not in symbol_path:
     print("Chromium symbol server is not in _NT_SYMBOL_PATH. No symbol stripping needed.")
     sys.exit(0)
 
+  # xperf puts the .symcache files in %_NT_SYMCACHE_PATH%, or c:\symcache if
+  # that isn't set.
+  symcache_root = os.environ.get("_NT_SYMCACHE_PATH") or r"c:\symcache"
+
   script_dir = os.path.dirname(sys.argv[0])
   retrieve_path = os.path.join(script_dir, "RetrieveSymbols.exe")
   pdbcopy_path = os.path.join(script_dir, "pdbcopy.exe")
-  if os.environ.has_key("programfiles(x86)"):
+  program_files = os.environ.get("programfiles(x86)")
+  if program_files:
     # The UIforETW copy of pdbcopy.exe fails to copy some Chrome PDBs that the
     # Windows 10 SDK version can copy - use it if present.
-    pdbcopy_install = os.path.join(os.environ["programfiles(x86)"], r"Windows kits\10\debuggers\x86\pdbcopy.exe")
+    pdbcopy_install = os.path.join(program_files, r"Windows kits\10\debuggers\x86\pdbcopy.exe")
     if os.path.exists(pdbcopy_install):
       pdbcopy_path = pdbcopy_install
 
@@ -98,12 +309,11 @@ def main():
   # RetrieveSymbols.exe requires some support files. dbghelp.dll and symsrv.dll
   # have to be in the same directory as RetrieveSymbols.exe and pdbcopy.exe must
   # be in the path, so copy them all to the script directory.
+  third_party_dir = os.path.normpath(os.path.join(script_dir, "..", "third_party"))
   for third_party in ["pdbcopy.exe", "dbghelp.dll", "symsrv.dll"]:
-    if not os.path.exists(third_party):
-      source = os.path.normpath(os.path.join(script_dir, r"..\third_party", \
-          third_party))
-      dest = os.path.normpath(os.path.join(script_dir, third_party))
-      shutil.copy2(source, dest)
+    source = os.path.join(third_party_dir, third_party)
+    dest = os.path.join(script_dir, third_party)
+    _CopyIfChanged(source, dest)
 
   if not os.path.exists(pdbcopy_path):
     print("pdbcopy.exe not found. No symbol stripping is possible.")
@@ -114,19 +324,12 @@ def main():
     sys.exit(0)
 
   tracename = sys.argv[1]
-  # Each symbol file that we pdbcopy gets copied to a separate directory so
-  # that we can support decoding symbols for multiple chrome versions without
-  # filename collisions.
-  tempdirs = []
-
-  # Typical output looks like:
-  # "[RSDS] PdbSig: {0e7712be-af06-4421-884b-496f833c8ec1}; Age: 33; Pdb: D:\src\chromium2\src\out\Release\initial\chrome.dll.pdb"
-  # Note that this output implies a .symcache filename like this:
-  # chrome.dll-0e7712beaf064421884b496f833c8ec121v2.symcache
-  # In particular, note that the xperf action prints the age in decimal, but the
-  # symcache names use the age in hexadecimal!
-  pdb_re = re.compile(r'"\[RSDS\] PdbSig: {(.*-.*-.*-.*-.*)}; Age: (.*); Pdb: (.*)"')
-  pdb_cached_re = re.compile(r"Found .*file - placed it in (.*)")
+  # Each symbol file that we pdbcopy gets copied to a separate subdirectory of
+  # this directory so that we can support decoding symbols for multiple chrome
+  # versions without filename collisions. The subdirectories use the symbol
+  # server layout (name.pdb\GUIDAGE\name.pdb) so that a single symbol path
+  # entry finds all of them. It is created when the first PDB is copied.
+  stripped_root = None
 
   print("Pre-translating chrome symbols from stripped PDBs to avoid 10-15 minute translation times "
         "and to work around WPA symbol download bugs.")
@@ -143,93 +346,178 @@ def main():
   command = 'xperf -i "%s" -tle -tti -a symcache -dbgid' % tracename
   print("> %s" % command)
   found_uncached = False
-  raw_command_output = subprocess.check_output(command, stderr=subprocess.STDOUT)
-  command_output = str(raw_command_output).splitlines()
 
-  for line in command_output:
+  # First find all of the uncached chrome PDBs so that they can be retrieved in
+  # parallel. Each entry is a (pe_match, guid, age, path, filepart, symcache_file)
+  # tuple.
+  uncached_pdbs = []
+  # The same chrome PDB reference is typically listed many times, such as once
+  # for each chrome process, so remember which lines have already been handled.
+  seen_lines = set()
+  # Lines can differ and still refer to the same PDB, so also track the PDBs
+  # themselves. Retrieving or copying one PDB twice is wasted work, and renaming
+  # the same local PDB twice would fail.
+  seen_pdbs = set()
+  # The output is scanned as bytes so that only the few lines that reference
+  # chrome PDBs have to be decoded.
+  for line in _IterLines(command, text=False):
     pe_match = None # This is the name to use when generating the .symcache files
-    # Complete list of Chrome executables and binaries. Some are only used in internal builds.
-    # Note that case matters for downloading PDBs.
-    for pe_name in ["chrome.exe.pdb", "chrome_proxy.exe.pdb", "chrome.dll.pdb", "blink_web.dll.pdb", "content.dll.pdb", "chrome_elf.dll.pdb", "chrome_watcher.dll.pdb", "libEGL.dll.pdb", "libGLESv2.dll.pdb", "eventlog_provider.dll.pdb"]:
-      if line.count("Pdb: " + pe_name) > 0:
+    for pe_name, marker in chrome_pdb_markers:
+      if marker in line:
         pe_match = pe_name
     if pe_match:
+      if line in seen_lines:
+        continue
+      seen_lines.add(line)
+      line = _DecodeOutput(line)
       match = pdb_re.match(line)
       if match:
         guid, age, path = match.groups()
         guid = guid.replace("-", "")
         age = int(age) # Prepare for printing as hex
-        filepart = os.path.split(path)[1]
+        if (guid, age) in seen_pdbs:
+          continue
+        seen_pdbs.add((guid, age))
         # Starting around 2018 xperf started generating symcache file names in a
         # way that is more compatible with symbol servers. If the symbol server
         # name is:
         #   "C:\symbols\chrome_child.dll.pdb\90E6CD6C673057E64C4C44205044422E1\chrome_child.dll.pdb
-        # then the symcache name will be:
+        # then the symcache name will be (with the default symcache path):
         #   c:\symcache\chrome_child.dll.pdb\90E6CD6C673057E64C4C44205044422E1\chrome_child.dll.pdb-v3.1.0.symcache
         # Handling all old names is out of scope for this script, so we just
         # handle the new names.
-        symcache_file = r"c:\symcache\%s\%s%s\%s-v3.1.0.symcache" % (pe_match, guid, age, pe_match)
+        symcache_file = os.path.join(symcache_root, pe_match, "%s%s" % (guid, age),
+                                     "%s-v3.1.0.symcache" % pe_match)
         if os.path.exists(symcache_file):
           print("Symcache file already exists: %s" % symcache_file)
           continue
-        # Only print messages for chrome PDBs that aren't in the symcache
-        found_uncached = True
-        print("Found uncached reference to %s: %s - %s" % (filepart, guid, age, ))
-        symcache_files.append(symcache_file)
-        pdb_cache_path = None
-        retrieve_command = "%s %s %s %s" % (retrieve_path, guid, age, filepart)
-        print("  > %s" % retrieve_command)
-        for subline in os.popen(retrieve_command):
-          cache_match = pdb_cached_re.match(subline.strip())
-          if cache_match:
-            pdb_cache_path = cache_match.groups()[0]
-            # RetrieveSymbols puts a period at the end of the output, so strip that.
-            if pdb_cache_path.endswith("."):
-              pdb_cache_path = pdb_cache_path[:-1]
-        if strip_and_translate and not pdb_cache_path:
-          # Look for locally built symbols
-          if os.path.exists(path):
-            pdb_cache_path = path
-            local_symbol_files.append(path)
-        if pdb_cache_path:
-          if strip_and_translate:
-            tempdir = tempfile.mkdtemp()
-            tempdirs.append(tempdir)
-            dest_path = os.path.join(tempdir, os.path.basename(pdb_cache_path))
-            print("  Copying PDB to %s" % dest_path)
-            # For some reason putting quotes around the command to be run causes
-            # it to fail. So don't do that.
-            copy_command = '%s "%s" "%s" -p' % (pdbcopy_path, pdb_cache_path, dest_path)
-            print("  > %s" % copy_command)
-            if un_fastlink_tool:
-              # If the un_fastlink_tool is available then run the pdbcopy command in a
-              # try block. If pdbcopy fails then run the un_fastlink_tool and try again.
-              try:
-                output = str(subprocess.check_output(copy_command, stderr=subprocess.STDOUT))
-                if output:
-                  print("  %s" % output, end="")
-              except:
-                convert_command = '%s "%s"' % (un_fastlink_tool, pdb_cache_path)
-                print("Attempting to un-fastlink PDB so that pdbcopy can strip it. This may be slow.")
-                print("  > %s" % convert_command)
-                subprocess.check_output(convert_command)
-                output = str(subprocess.check_output(copy_command, stderr=subprocess.STDOUT))
-                if output:
-                  print("  %s" % output, end="")
-            else:
-              output = str(subprocess.check_output(copy_command, stderr=subprocess.STDOUT))
-              if output:
-                print("  %s" % output, end="")
-            if not os.path.exists(dest_path):
-              print("Aborting symbol generation because stripped PDB '%s' does not exist. WPA symbol loading may be slow." % dest_path)
-              sys.exit(0)
-          else:
-            print("   Symbols retrieved.")
-        else:
-          print("  Failed to retrieve symbols.")
+        filepart = os.path.basename(path)
+        uncached_pdbs.append((pe_match, guid, age, path, filepart, symcache_file))
+
+  # PDBs that recently failed to be retrieved are skipped.
+  failed_retrieves = _LoadFailedRetrieves()
+  if os.environ.get(failed_retrieves_override):
+    recently_failed = set()
+  else:
+    recently_failed = set(failed_retrieves)
+  failed_retrieves_changed = False
 
-  if tempdirs:
-    symbol_path = ";".join(tempdirs)
+  # Retrieving symbols is dominated by network latency so run the
+  # RetrieveSymbols.exe instances in parallel. The progress messages are printed
+  # first so that they show up in UIforETW while the downloads are running, and
+  # the results are processed in order afterwards.
+  # The tools are launched directly rather than batched through a cmd.exe
+  # script because cmd.exe would still create a process for each command, and
+  # would run them serially.
+  to_retrieve = []
+  for index, (pe_match, guid, age, path, filepart, symcache_file) in enumerate(uncached_pdbs):
+    # Only print messages for chrome PDBs that aren't in the symcache
+    found_uncached = True
+    print("Found uncached reference to %s: %s - %s" % (filepart, guid, age, ))
+    symcache_files.append(symcache_file)
+    if _FailedRetrieveKey(guid, age, filepart) in recently_failed:
+      print("  Skipping retrieval because the symbols were not found within the last %d hours." % (failed_retrieve_skip_time / 3600))
+      print("  Delete %s or set %s=1 to retry." % (failed_retrieves_path, failed_retrieves_override))
+    else:
+      retrieve_command = "%s %s %s %s" % (retrieve_path, guid, age, filepart)
+      print("  > %s" % retrieve_command)
+      to_retrieve.append(index)
+  # Skipped PDBs keep the (None, False) result of a retrieval that didn't run.
+  retrieve_results = [(None, False)] * len(uncached_pdbs)
+  if to_retrieve:
+    pool = ThreadPool(min(max_parallel_retrieves, len(to_retrieve)))
+    try:
+      results = pool.map(lambda index: _RetrieveSymbols(retrieve_path,
+                                                        uncached_pdbs[index][1],
+                                                        uncached_pdbs[index][2],
+                                                        uncached_pdbs[index][4]),
+                         to_retrieve)
+    finally:
+      pool.close()
+      pool.join()
+    for index, result in zip(to_retrieve, results):
+      retrieve_results[index] = result
+
+  # Each entry is a (copy_command, pdb_cache_path, dest_path) tuple. Each
+  # pdbcopy.exe is independent so they are run in parallel once all of the
+  # PDBs are known.
+  pdb_copies = []
+  pdb_copy_dests = set()
+  for (pe_match, guid, age, path, filepart, symcache_file), (pdb_cache_path, not_found) in \
+      zip(uncached_pdbs, retrieve_results):
+    retrieve_key = _FailedRetrieveKey(guid, age, filepart)
+    if pdb_cache_path and retrieve_key in failed_retrieves:
+      del failed_retrieves[retrieve_key]
+      failed_retrieves_changed = True
+    if strip_and_translate and not pdb_cache_path:
+      # Look for locally built symbols
+      if not os.path.exists(path) and os.path.exists(path + "x"):
+        # A previous run was killed before it could rename the PDB back.
+        print("Renaming %sx back to %s." % (path, path))
+        try:
+          os.rename(path + "x", path)
+        except:
+          # Rename can and does throw exceptions. We must catch and continue.
+          e = sys.exc_info()[0]
+          print("Hit exception while renaming %sx back. Continuing.\n%s" % (path, e))
+      if os.path.exists(path):
+        pdb_cache_path = path
+        local_symbol_files.append(path)
+    # Only remember that the symbol server doesn't have a PDB when it was built
+    # locally, since then it never will.
+    if not_found and os.path.exists(path):
+      failed_retrieves[retrieve_key] = time.time()
+      failed_retrieves_changed = True
+    if pdb_cache_path:
+      if strip_and_translate:
+        if not stripped_root:
+          stripped_root = tempfile.mkdtemp(prefix="StripChromeSymbols_")
+        tempdir = os.path.join(stripped_root, filepart, "%s%X" % (guid.upper(), age))
+        if not os.path.exists(tempdir):
+          os.makedirs(tempdir)
+        dest_path = os.path.join(tempdir, filepart)
+        print("Copying %s to %s" % (pdb_cache_path, dest_path))
+        # Locally built PDBs have to be stripped as well - a plain copy would
+        # be just as slow to translate as the original, which is the problem
+        # that this script exists to avoid.
+        # For some reason putting quotes around the command to be run causes
+        # it to fail. So don't do that.
+        copy_command = '%s "%s" "%s" -p' % (pdbcopy_path, pdb_cache_path, dest_path)
+        print("  > %s" % copy_command)
+        # Two pdbcopy instances must not write the same file at once.
+        if dest_path not in pdb_copy_dests:
+          pdb_copy_dests.add(dest_path)
+          pdb_copies.append((copy_command, pdb_cache_path, dest_path))
+      else:
+        print("Symbols for %s retrieved." % filepart)
+    else:
+      print("Failed to retrieve symbols for %s: %s - %s" % (filepart, guid, age))
+
+  if failed_retrieves_changed:
+    _SaveFailedRetrieves(failed_retrieves)
+
+  if pdb_copies:
+    pool = ThreadPool(min(cpu_count(), len(pdb_copies)))
+    try:
+      copy_outputs = pool.map(lambda copy: _StripPdb(copy[0], un_fastlink_tool, copy[1]),
+                              pdb_copies)
+    finally:
+      pool.close()
+      pool.join()
+    # Print all of the output before checking the results, so that no failure
+    # hides the output of the other copies. The "Copying" messages were printed
+    # before the copies started so label each output with its PDB.
+    for (copy_command, pdb_cache_path, dest_path), output in zip(pdb_copies, copy_outputs):
+      if output:
+        print("Output from stripping %s:" % pdb_cache_path)
+        print(output, end="")
+    for copy_command, pdb_cache_path, dest_path in pdb_copies:
+      if not os.path.exists(dest_path):
+        print("Aborting symbol generation because stripped PDB '%s' does not exist. WPA symbol loading may be slow." % dest_path)
+        sys.exit(0)
+
+  if stripped_root:
+    symbol_path = "srv*%s" % stripped_root
     print("Stripped PDBs are in %s. Converting to symcache files now." % symbol_path)
     os.environ["_NT_SYMBOL_PATH"] = symbol_path
     # Create a list of to/from renamed tuples
@@ -260,20 +548,24 @@ def main():
       else:
         gen_command = 'xperf -i "%s" -symbols -tle -tti -a symcache -build' % tracename
         print("> %s" % gen_command)
-        for line in os.popen(gen_command).readlines():
-          pass # Don't print line
+        # The output isn't printed so send it straight to the null device
+        # rather than reading it into this process.
+        with open(os.devnull, "r+") as devnull:
+          subprocess.call(gen_command, stdin=devnull, stdout=devnull)
     except KeyboardInterrupt:
       # Catch Ctrl+C exception so that PDBs will get renamed back.
       if renames:
         print("Ctrl+C detected. Renaming PDBs back.")
       error = True
-    for rename_names in renames:
-      try:
-        os.rename(rename_names[1], rename_names[0])
-      except:
-        # Rename can and does throw exceptions. We must catch and continue.
-        e = sys.exc_info()[0]
-        print("Hit exception while renaming %s back. Continuing.\n%s" % (rename_names[1], e))
+    finally:
+      # Rename the PDBs back even if xperf could not be run.
+      for rename_names in renames:
+        try:
+          os.rename(rename_names[1], rename_names[0])
+        except:
+          # Rename can and does throw exceptions. We must catch and continue.
+          e = sys.exc_info()[0]
+          print("Hit exception while renaming %s back. Continuing.\n%s" % (rename_names[1], e))
     for symcache_file in symcache_files:
       if os.path.exists(symcache_file):
         print("%s generated." % symcache_file)
@@ -286,8 +578,7 @@ def main():
       print("If re-running the command be sure to go:")
       print("set _NT_SYMBOL_PATH=%s" % symbol_path)
     else:
-      for directory in tempdirs:
-        shutil.rmtree(directory, ignore_errors=True)
+      shutil.rmtree(stripped_root, ignore_errors=True)
   elif strip_and_translate:
     if found_uncached:
       print("No PDBs copied, nothing to do.")